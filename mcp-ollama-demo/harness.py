@@ -1,14 +1,67 @@
 import json
 import asyncio
-import re
+import hashlib
+import os
+import threading
 import traceback
-import requests
+from collections import OrderedDict
+from dataclasses import dataclass
+import httpx
+import orjson
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from mcp.types import TextContent
+
+try:
+    from mcp.shared.exceptions import McpError
+except ImportError:  # renamed to MCPError in mcp 2.x
+    from mcp.shared.exceptions import MCPError as McpError
 
 # Change model if desired
 MODEL = "qwen2.5:7b"
 OLLAMA_CHAT = "http://localhost:11434/api/chat"
+OLLAMA_TIMEOUT = 120
+# Keep the model resident between prompts instead of Ollama's 5m default.
+KEEP_ALIVE = "30m"
+# Set DEBUG=1 to include tracebacks in tool loop errors.
+DEBUG = os.environ.get("DEBUG") == "1"
+JSON_HEADERS = {"Content-Type": "application/json"}
+# Chunks read past the first complete JSON object while waiting for "done".
+STREAM_DRAIN_CHUNKS = 2
+CONTENT_KEY = b'"content":"'
+
+# Only the last two steps (HISTORY_WINDOW messages) are re-sent verbatim.
+# Anything older is folded into one templated summary of at most
+# MAX_SUMMARY_LINES snippets, which is also what keeps stale tool results
+# short. Each step adds two messages, so folding starts before the fourth
+# decision and then holds the history at prompt + summary + two steps.
+HISTORY_WINDOW = 4
+MAX_HISTORY_MESSAGES = 1 + HISTORY_WINDOW  # user prompt + window
+HISTORY_SNIPPET_CHARS = 200
+MAX_SUMMARY_LINES = 8
+HISTORY_SUMMARY_HEADER = "Summary of earlier steps:"
+
+# Batched calls to read-only tools run concurrently, capped so the MCP server
+# is not flooded. Mutating tools stay sequential to keep batch order meaningful.
+MAX_CONCURRENT_TOOL_CALLS = 8
+READ_ONLY_TOOL_PREFIXES = ("list_", "read_", "search_", "get_")
+
+# Expected failures inside the tool loop, reported as "Tool loop error.".
+# Bad model output (wrong shapes or field types) is raised as RuntimeError by
+# Decision.from_json and run(), so it lands here too; other exception types
+# indicate a harness bug and propagate to main()'s handler.
+TOOL_LOOP_ERRORS = (
+    RuntimeError,
+    ValueError,
+    ConnectionError,
+    asyncio.TimeoutError,
+    httpx.HTTPError,
+    McpError,
+)
+
+# Exact-match cache of raw decisions, keyed by a hash of the encoded payload.
+DECISION_CACHE_SIZE = 256
+_DECISION_CACHE: OrderedDict[bytes, str] = OrderedDict()
 
 SYSTEM = """You are an MCP assistant that can either chat or take actions with tools.
 
@@ -45,26 +98,120 @@ Rules:
 """
 
 
-def ollama_decide(tools_schema, messages):
+def make_ollama_client() -> httpx.AsyncClient:
+    # One keep-alive connection pool shared by every Ollama call in a session.
+    return httpx.AsyncClient(
+        timeout=OLLAMA_TIMEOUT,
+        limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+    )
+
+
+async def ollama_chat(client: httpx.AsyncClient, body: bytes):
+    # Callers pass orjson-encoded bytes, skipping httpx's stdlib json round-trip.
+    # Responses are streamed and we stop once the text holds one complete JSON
+    # object. Usually the next chunk is the final "done" line; reading up to
+    # STREAM_DRAIN_CHUNKS more lets the response finish so httpx keeps the
+    # connection pooled. If the model is still generating after that, we stop
+    # reading: the connection is dropped, but Ollama stops generating too.
+    parts = []
+    complete = None
+    drained = 0
+    async with client.stream("POST", OLLAMA_CHAT, content=body, headers=JSON_HEADERS) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if not line:
+                continue
+            if complete is not None:
+                drained += 1
+                if drained > STREAM_DRAIN_CHUNKS:
+                    break
+                continue
+            try:
+                delta = extract_message_content(line.encode())
+            except KeyError:
+                raise RuntimeError(f"Unexpected Ollama stream chunk: {line}") from None
+            parts.append(delta)
+            if "}" in delta:
+                text = "".join(parts)
+                if has_complete_json_object(text):
+                    complete = text
+    return complete if complete is not None else "".join(parts)
+
+
+def has_complete_json_object(text: str) -> bool:
+    # Only a leading object counts; otherwise the preamble scan in
+    # parse_first_json_object would match an inner object of e.g. [{"a":1}.
+    if not text.lstrip().startswith("{"):
+        return False
+    try:
+        return isinstance(parse_first_json_object(text), dict)
+    except ValueError:
+        return False
+
+
+async def warm_model(client: httpx.AsyncClient):
+    # An empty message list makes Ollama load the model without generating.
+    payload = {"model": MODEL, "messages": [], "stream": False, "keep_alive": KEEP_ALIVE}
+    try:
+        r = await client.post(OLLAMA_CHAT, content=orjson.dumps(payload), headers=JSON_HEADERS)
+        r.raise_for_status()
+    except httpx.HTTPError as exc:
+        print(f"\n(model warm-up failed: {exc})")
+
+
+def extract_message_content(body: bytes) -> str:
+    # Decode only the message.content string instead of the whole response
+    # (timings, token counts, ...). Falls back to a full decode if the
+    # targeted scan does not find a well-formed string.
+    start = body.find(CONTENT_KEY)
+    if start != -1:
+        start += len(CONTENT_KEY) - 1  # keep the opening quote
+        end = body.find(b'"', start + 1)
+        while end != -1:
+            backslashes = 0
+            while body[end - 1 - backslashes] == 0x5C:
+                backslashes += 1
+            if backslashes % 2 == 0:
+                try:
+                    value = orjson.loads(body[start : end + 1])
+                except orjson.JSONDecodeError:
+                    break
+                if isinstance(value, str):
+                    return value
+                break
+            end = body.find(b'"', end + 1)
+
+    return orjson.loads(body)["message"]["content"]
+
+
+def build_system_messages(tools_schema):
+    # Built once per session; the tool schema never changes between steps.
+    return (
+        {"role": "system", "content": SYSTEM},
+        {"role": "system", "content": "Available tools:\n" + orjson.dumps(tools_schema).decode()},
+    )
+
+
+def encode_decide_payload(messages) -> bytes:
+    # `messages` already starts with the system prefix; send it as-is.
     payload = {
         "model": MODEL,
-        "stream": False,
-        "messages": [
-            {"role": "system", "content": SYSTEM},
-            {"role": "system", "content": "Available tools:\n" + json.dumps(tools_schema)},
-            *messages,
-        ],
+        "stream": True,
+        "keep_alive": KEEP_ALIVE,
+        # Grammar-constrained sampling: Ollama only emits valid JSON, so the
+        # repair call below is a last-resort fallback.
+        "format": "json",
+        "messages": messages,
     }
-
-    r = requests.post(OLLAMA_CHAT, json=payload, timeout=120)
-    r.raise_for_status()
-    return r.json()["message"]["content"]
+    return orjson.dumps(payload)
 
 
-def ollama_repair_json(raw_text):
+async def ollama_repair_json(client: httpx.AsyncClient, raw_text):
     payload = {
         "model": MODEL,
-        "stream": False,
+        "stream": True,
+        "keep_alive": KEEP_ALIVE,
+        "format": "json",
         "messages": [
             {"role": "system", "content": REPAIR_SYSTEM},
             {
@@ -74,19 +221,33 @@ def ollama_repair_json(raw_text):
         ],
     }
 
-    r = requests.post(OLLAMA_CHAT, json=payload, timeout=120)
-    r.raise_for_status()
-    return r.json()["message"]["content"]
+    return await ollama_chat(client, orjson.dumps(payload))
+
+
+def cache_decision(key: bytes, raw: str):
+    _DECISION_CACHE[key] = raw
+    _DECISION_CACHE.move_to_end(key)
+    if len(_DECISION_CACHE) > DECISION_CACHE_SIZE:
+        _DECISION_CACHE.popitem(last=False)
+
 
+async def decide_with_repair(client: httpx.AsyncClient, messages):
+    body = encode_decide_payload(messages)
+    key = hashlib.blake2b(body, digest_size=16).digest()
+    # Callers store the raw output under `key` with cache_decision() only once
+    # the decision has been validated, so unusable samples are never reused.
+    cached = _DECISION_CACHE.get(key)
+    if cached is not None:
+        _DECISION_CACHE.move_to_end(key)
+        return parse_first_json_object(cached), cached, key
 
-def decide_with_repair(tools_schema, messages):
-    raw = ollama_decide(tools_schema, messages)
+    raw = await ollama_chat(client, body)
     try:
-        return parse_first_json_object(raw), raw
+        return parse_first_json_object(raw), raw, key
     except Exception:
-        repaired = ollama_repair_json(raw)
+        repaired = await ollama_repair_json(client, raw)
         try:
-            return parse_first_json_object(repaired), repaired
+            return parse_first_json_object(repaired), repaired, key
         except Exception as exc:
             raise RuntimeError(
                 "Ollama returned malformed JSON and repair failed.\n"
@@ -94,147 +255,325 @@ def decide_with_repair(tools_schema, messages):
             ) from exc
 
 
-DEFERRED_ACTION_RE = re.compile(
-    r"\b(let me|i(?:'| wi)ll|allow me|i can check|i can look|i can verify)\b",
-    re.IGNORECASE,
+DEFERRED_ACTION_PHRASES = (
+    "let me",
+    "i'll",
+    "i will",
+    "allow me",
+    "i can check",
+    "i can look",
+    "i can verify",
 )
 
 
-def looks_like_deferred_action_chat(message: str) -> bool:
-    return bool(message and DEFERRED_ACTION_RE.search(message))
-
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
 
-async def run(prompt: str, max_steps: int = 8):
-    # Launch MCP server as child process
-    server_params = StdioServerParameters(
-        command="npx",
-        args=["tsx", "server.ts"],
-    )
 
-    async with stdio_client(server_params) as (read, write):
-        async with ClientSession(read, write) as session:
-            await session.initialize()
-
-            tools = await session.list_tools()
-            tools_schema = [
-                {
-                    "name": t.name,
-                    "description": t.description,
-                    "inputSchema": t.inputSchema,
-                }
-                for t in tools.tools
-            ]
-
-            messages = [{"role": "user", "content": prompt}]
+def looks_like_deferred_action_chat(message: str) -> bool:
+    # Plain substring scan over a handful of short phrases; cheaper than the
+    # regex VM. Word boundaries are checked by hand to match the old \b...\b.
+    if not message:
+        return False
+    lowered = message.lower()
+    for phrase in DEFERRED_ACTION_PHRASES:
+        idx = lowered.find(phrase)
+        while idx != -1:
+            end = idx + len(phrase)
+            if (idx == 0 or not _is_word_char(lowered[idx - 1])) and (
+                end == len(lowered) or not _is_word_char(lowered[end])
+            ):
+                return True
+            idx = lowered.find(phrase, idx + 1)
+    return False
+
+
+def is_read_only_tool(tool_name: str) -> bool:
+    return tool_name.startswith(READ_ONLY_TOOL_PREFIXES)
+
+
+async def gather_or_cancel(coros):
+    # Like asyncio.gather, but if one call fails the rest are cancelled and
+    # awaited, so nothing keeps running on the shared session after run() ends.
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def compact_history(messages, prompt_index: int):
+    # The system prefix and the user prompt at prompt_index are kept verbatim.
+    if len(messages) - prompt_index <= MAX_HISTORY_MESSAGES:
+        return
+
+    head = prompt_index + 1
+    lines = []
+    for m in messages[head:-HISTORY_WINDOW]:
+        content = m["content"]
+        if content.startswith(HISTORY_SUMMARY_HEADER):
+            lines.extend(content[len(HISTORY_SUMMARY_HEADER) + 1 :].split("\n"))
+            continue
+        snippet = content[:HISTORY_SNIPPET_CHARS].replace("\n", " ")
+        if len(content) > HISTORY_SNIPPET_CHARS:
+            snippet += " ..."
+        lines.append(f"- {m['role']}: {snippet}")
+
+    # Keep only the most recent lines so the summary stays a fixed size.
+    summary = HISTORY_SUMMARY_HEADER + "\n" + "\n".join(lines[-MAX_SUMMARY_LINES:])
+    messages[head:-HISTORY_WINDOW] = [{"role": "user", "content": summary}]
+
+
+@dataclass(slots=True)
+class Decision:
+    mode: str
+    message: str
+    tool: str | None
+    args: object
+
+    @classmethod
+    def from_json(cls, obj, raw: str) -> "Decision":
+        if not isinstance(obj, dict):
+            raise RuntimeError(f"Decision must be a JSON object.\nRaw:\n{raw}")
+
+        tool = obj.get("tool")
+        if tool is not None and not isinstance(tool, str):
+            raise RuntimeError(f"Decision tool must be a string.\nRaw:\n{raw}")
+
+        message = obj.get("message") or obj.get("final") or ""
+        if not isinstance(message, str):
+            raise RuntimeError(f"Decision message must be a string.\nRaw:\n{raw}")
+
+        mode = obj.get("mode")
+        # Backward compatibility with old schema:
+        # {"tool": "...", "args": {...}} or {"final": "..."}
+        if mode is None:
+            mode = "action" if tool is not None else "chat"
+
+        return cls(
+            mode=mode,
+            message=message,
+            tool=tool,
+            args=obj.get("args", {}),
+        )
+
+
+async def list_tools_schema(session: ClientSession):
+    tools = await session.list_tools()
+    return [
+        {
+            "name": t.name,
+            "description": t.description,
+            "inputSchema": t.inputSchema,
+        }
+        for t in tools.tools
+    ]
+
+
+async def run(
+    client: httpx.AsyncClient,
+    session: ClientSession,
+    system_messages,
+    prompt: str,
+    max_steps: int = 8,
+):
+    # System prefix is shared across turns; each step only appends to the tail.
+    messages = [*system_messages, {"role": "user", "content": prompt}]
+    prompt_index = len(system_messages)
+    tool_slots = asyncio.Semaphore(MAX_CONCURRENT_TOOL_CALLS)
+    # Read-only tool results seen this run, keyed by (tool, canonical args).
+    tool_cache: dict[tuple[str, bytes], str] = {}
 
-            try:
-                for step in range(max_steps):
-                    decision, raw = decide_with_repair(tools_schema, messages)
-
-                    mode = decision.get("mode")
-
-                    # Backward compatibility with old schema:
-                    # {"tool": "...", "args": {...}} or {"final": "..."}
-                    if mode is None:
-                        if decision.get("tool") is not None:
-                            mode = "action"
-                        else:
-                            mode = "chat"
-
-                    if mode == "chat":
-                        message = decision.get("message") or decision.get("final", "")
-                        # Avoid ending the turn on "I'll check..." planning chatter.
-                        if message and looks_like_deferred_action_chat(message) and step < max_steps - 1:
-                            messages.append({"role": "assistant", "content": raw})
-                            messages.append(
-                                {
-                                    "role": "user",
-                                    "content": (
-                                        "Do not narrate intent. Either call one tool now, "
-                                        "or return a direct final answer based on available context."
-                                    ),
-                                }
-                            )
-                            continue
-
-                        if message:
-                            return message
-                        return f"(empty chat response)\nRaw model output:\n{raw}"
-
-                    if mode != "action":
-                        raise RuntimeError(f"Invalid decision mode: {mode!r}\nRaw:\n{raw}")
-
-                    tool_name = decision.get("tool")
-                    if not tool_name:
-                        raise RuntimeError(f"Action mode missing tool name.\nRaw:\n{raw}")
-
-                    args = decision.get("args", {})
-                    if isinstance(args, dict):
-                        args_list = [args]
-                    elif isinstance(args, list) and all(isinstance(a, dict) for a in args):
-                        args_list = args
-                    else:
-                        raise RuntimeError(
-                            "Action args must be a JSON object or a list of JSON objects.\n"
-                            f"Raw:\n{raw}"
-                        )
-
-                    if len(args_list) > 20:
-                        raise RuntimeError(
-                            f"Refusing oversized batched action with {len(args_list)} calls (max 20)."
-                        )
-
-                    tool_results = []
-                    for one_args in args_list:
-                        result = await session.call_tool(tool_name, one_args)
-                        tool_text = "\n".join(
-                            c.text
-                            for c in result.content
-                            if getattr(c, "type", None) == "text"
-                        )
-                        tool_results.append(tool_text)
-
-                    # Feed tool result(s) back into conversation
+    try:
+        for step in range(max_steps):
+            compact_history(messages, prompt_index)
+            obj, raw, cache_key = await decide_with_repair(client, messages)
+            decision = Decision.from_json(obj, raw)
+            mode = decision.mode
+
+            if mode == "chat":
+                message = decision.message
+                if message:
+                    cache_decision(cache_key, raw)
+                # Avoid ending the turn on "I'll check..." planning chatter.
+                if message and looks_like_deferred_action_chat(message) and step < max_steps - 1:
                     messages.append({"role": "assistant", "content": raw})
-                    joined_results = "\n\n".join(
-                        f"Result {idx + 1}:\n{txt}" for idx, txt in enumerate(tool_results)
-                    )
                     messages.append(
-                        {"role": "user", "content": f"Tool result:\n{joined_results}"}
+                        {
+                            "role": "user",
+                            "content": (
+                                "Do not narrate intent. Either call one tool now, "
+                                "or return a direct final answer based on available context."
+                            ),
+                        }
                     )
-            except Exception as exc:
-                return (
-                    "Tool loop error.\n"
-                    f"{type(exc).__name__}: {exc}\n"
-                    f"{traceback.format_exc(limit=3)}"
+                    continue
+
+                if message:
+                    return message
+                return f"(empty chat response)\nRaw model output:\n{raw}"
+
+            if mode != "action":
+                raise RuntimeError(f"Invalid decision mode: {mode!r}\nRaw:\n{raw}")
+
+            tool_name = decision.tool
+            if not tool_name:
+                raise RuntimeError(f"Action mode missing tool name.\nRaw:\n{raw}")
+
+            args = decision.args
+            if isinstance(args, dict):
+                args_list = [args]
+            elif isinstance(args, list) and all(isinstance(a, dict) for a in args):
+                args_list = args
+            else:
+                raise RuntimeError(
+                    "Action args must be a JSON object or a list of JSON objects.\n"
+                    f"Raw:\n{raw}"
                 )
 
-            return "(stopped: max steps reached)"
+            if len(args_list) > 20:
+                raise RuntimeError(
+                    f"Refusing oversized batched action with {len(args_list)} calls (max 20)."
+                )
+            cache_decision(cache_key, raw)
+
+            async def call_one(one_args):
+                async with tool_slots:
+                    result = await session.call_tool(tool_name, one_args)
+                return "\n".join([c.text for c in result.content if isinstance(c, TextContent)])
+
+            if is_read_only_tool(tool_name):
+                keys = [(tool_name, orjson.dumps(a, option=orjson.OPT_SORT_KEYS)) for a in args_list]
+                # Dedupe within the batch too, so repeated args are called once.
+                pending = {k: a for k, a in zip(keys, args_list) if k not in tool_cache}
+                texts = await gather_or_cancel(call_one(a) for a in pending.values())
+                tool_cache.update(zip(pending, texts))
+                tool_results = [tool_cache[k] for k in keys]
+            else:
+                # Any mutation may change what read-only tools would return.
+                tool_cache.clear()
+                tool_results = [await call_one(a) for a in args_list]
+
+            # Feed tool result(s) back into conversation
+            messages.append({"role": "assistant", "content": raw})
+            joined_results = "\n\n".join(
+                ["Result %d:\n%s" % (idx, txt) for idx, txt in enumerate(tool_results, 1)]
+            )
+            messages.append({"role": "user", "content": f"Tool result:\n{joined_results}"})
+    except TOOL_LOOP_ERRORS as exc:
+        error = f"Tool loop error.\n{type(exc).__name__}: {exc}"
+        if DEBUG:
+            error += "\n" + traceback.format_exc(limit=3)
+        return error
+
+    return "(stopped: max steps reached)"
+
+_JSON_DECODER = json.JSONDecoder()
+
 
 def parse_first_json_object(s: str):
+    # Fast path: well-behaved output starts with the object itself, so skip
+    # the strip() scan and preamble handling entirely. orjson handles the
+    # common clean-document case; raw_decode covers trailing text.
+    if s[:1] == "{":
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass
+        try:
+            return _JSON_DECODER.raw_decode(s)[0]
+        except json.JSONDecodeError:
+            pass
+
     s = s.strip()
-    decoder = json.JSONDecoder()
-    obj, _idx = decoder.raw_decode(s)   # raw_decode parses the first JSON value only
-    return obj
+    # orjson has no raw_decode equivalent, so trailing text still needs stdlib.
+    # Skip any prose preamble or ```json fence and try from each "{" in turn,
+    # so the LLM repair call stays a rare fallback. Starting only at "{" means
+    # the result is always an object, never a leading number/string/list.
+    idx = s.find("{")
+    if idx == -1:
+        raise json.JSONDecodeError("No JSON object found", s, 0)
+    while True:
+        try:
+            obj, _idx = _JSON_DECODER.raw_decode(s, idx)   # raw_decode parses the first JSON value only
+            return obj
+        except json.JSONDecodeError:
+            # A malformed object that really starts like one ({"...) goes to
+            # repair; scanning on could return one of its nested objects.
+            if s.startswith("{", idx) and s[idx + 1 :].lstrip().startswith('"'):
+                raise
+            idx = s.find("{", idx + 1)
+            if idx == -1:
+                raise
+
+def read_input_lines(loop, lines: asyncio.Queue, ready: threading.Semaphore):
+    # Runs in a daemon thread so a blocked input() never holds up the event
+    # loop or interpreter shutdown. Prompts only when main() asks for a line;
+    # None signals EOF. Ctrl-C is delivered to the main thread, not here.
+    while True:
+        ready.acquire()
+        try:
+            line = input(">>> ")
+        except EOFError:
+            line = None
+        loop.call_soon_threadsafe(lines.put_nowait, line)
+        if line is None:
+            return
+
 
 async def main():
     print("Type 'exit' to quit.\n")
 
-    while True:
-        user_input = input(">>> ")
-
-        if user_input.lower() in ["exit", "quit"]:
-            break
+    # Launch MCP server as child process, once for the whole REPL session
+    server_params = StdioServerParameters(
+        command="npx",
+        args=["tsx", "server.ts"],
+    )
 
+    async with make_ollama_client() as client:
+        # Load the model while the MCP server starts so the first prompt
+        # does not pay the cold start.
+        warmup = asyncio.create_task(warm_model(client))
         try:
-            result = await run(user_input)
-            print("\n--- RESULT ---")
-            print(result)
-            print()
-        except Exception as exc:
-            print("\n--- ERROR ---")
-            print(exc)
-            print()
+            async with stdio_client(server_params) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    system_messages = build_system_messages(await list_tools_schema(session))
+
+                    # Read input off the event loop so the MCP transport and the
+                    # model warm-up keep running while we wait for the user.
+                    lines = asyncio.Queue()
+                    ready = threading.Semaphore(0)
+                    threading.Thread(
+                        target=read_input_lines,
+                        args=(asyncio.get_running_loop(), lines, ready),
+                        daemon=True,
+                    ).start()
+
+                    while True:
+                        ready.release()
+                        user_input = await lines.get()
+
+                        if user_input is None or user_input.lower() in ["exit", "quit"]:
+                            break
+
+                        try:
+                            result = await run(client, session, system_messages, user_input)
+                            print("\n--- RESULT ---")
+                            print(result)
+                            print()
+                        except Exception as exc:
+                            print("\n--- ERROR ---")
+                            print(exc)
+                            print()
+        finally:
+            warmup.cancel()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# harness.py is a script, not an installed package; make it importable here.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,208 @@
+import json
+
+import orjson
+import pytest
+
+from harness import (
+    HISTORY_SNIPPET_CHARS,
+    HISTORY_SUMMARY_HEADER,
+    HISTORY_WINDOW,
+    MAX_SUMMARY_LINES,
+    compact_history,
+    extract_message_content,
+    has_complete_json_object,
+    parse_first_json_object,
+)
+
+
+def chat_chunk(content, **extra):
+    return orjson.dumps(
+        {
+            "model": "qwen2.5:7b",
+            "created_at": "2026-01-01T00:00:00Z",
+            "message": {"role": "assistant", "content": content},
+            "done": False,
+            **extra,
+        }
+    )
+
+
+# --- extract_message_content -------------------------------------------------
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "",
+        "plain text",
+        'escaped "quotes" inside',
+        "trailing backslash \\",
+        "two trailing backslashes \\\\",
+        'backslash then quote \\"',
+        '{"mode":"chat","message":"line1\\nline2"}',
+        "newline\nand tab\t",
+        "unicode é \U0001f600",
+    ],
+)
+def test_extract_message_content_round_trips(content):
+    assert extract_message_content(chat_chunk(content)) == content
+
+
+def test_extract_message_content_ignores_escaped_key_in_earlier_string():
+    body = orjson.dumps(
+        {
+            "model": 'tricky "content":"nope"',
+            "message": {"role": "assistant", "content": "real"},
+        }
+    )
+    assert extract_message_content(body) == "real"
+
+
+def test_extract_message_content_final_done_chunk():
+    body = chat_chunk("", done=True, done_reason="stop", eval_count=42)
+    assert extract_message_content(body) == ""
+
+
+def test_extract_message_content_falls_back_to_full_decode():
+    body = b'{"message": {"role": "assistant", "content": "spaced"}}'
+    assert extract_message_content(body) == "spaced"
+
+
+def test_extract_message_content_error_chunk_raises_key_error():
+    # ollama_chat turns this into a RuntimeError naming the chunk.
+    with pytest.raises(KeyError):
+        extract_message_content(b'{"error":"model not found"}')
+
+
+# --- parse_first_json_object -------------------------------------------------
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        '{"mode":"chat","message":"hi"}',
+        '  {"mode":"chat","message":"hi"}\n',
+        '{"mode":"chat","message":"hi"} and some trailing prose',
+        '```json\n{"mode":"chat","message":"hi"}\n```',
+        'Sure! Here you go:\n{"mode":"chat","message":"hi"}',
+        '1 file found: {"mode":"chat","message":"hi"}',
+        '"ok" {"mode":"chat","message":"hi"}',
+        'Use {dir} here: {"mode":"chat","message":"hi"}',
+    ],
+)
+def test_parse_first_json_object_finds_the_decision(text):
+    assert parse_first_json_object(text) == {"mode": "chat", "message": "hi"}
+
+
+def test_parse_first_json_object_only_returns_objects():
+    assert parse_first_json_object('[{"a":1}]') == {"a": 1}
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "no json here",
+        "42",
+        # A malformed object must go to repair rather than yield a nested one.
+        '{"mode":"action","args":{"dir":"."}',
+        '{"a":"x\ny","b":{"c":1}}',
+        'prose {"a":"x\ny","b":{"c":1}}',
+    ],
+)
+def test_parse_first_json_object_raises(text):
+    with pytest.raises(json.JSONDecodeError):
+        parse_first_json_object(text)
+
+
+@pytest.mark.parametrize(
+    ("text", "expected"),
+    [
+        ('{"a":1}', True),
+        ('  {"a":{"b":1}}', True),
+        ('{"a":{"b":1}', False),
+        ('[{"a":1}', False),
+        ('pre {"a":1}', False),
+    ],
+)
+def test_has_complete_json_object(text, expected):
+    assert has_complete_json_object(text) is expected
+
+
+# --- compact_history ---------------------------------------------------------
+
+SYSTEM_PREFIX = [
+    {"role": "system", "content": "system"},
+    {"role": "system", "content": "tools"},
+]
+PROMPT_INDEX = len(SYSTEM_PREFIX)
+
+
+def history_after(steps, result="Tool result:\nok"):
+    messages = [*SYSTEM_PREFIX, {"role": "user", "content": "prompt"}]
+    for step in range(steps):
+        compact_history(messages, PROMPT_INDEX)
+        messages.append({"role": "assistant", "content": f"raw{step}"})
+        messages.append({"role": "user", "content": result})
+    return messages
+
+
+def summary_lines(messages):
+    summary = messages[PROMPT_INDEX + 1]["content"]
+    assert summary.startswith(HISTORY_SUMMARY_HEADER + "\n")
+    return summary.split("\n")[1:]
+
+
+def test_compact_history_leaves_short_history_alone():
+    messages = history_after(2)
+    before = [dict(m) for m in messages]
+    compact_history(messages, PROMPT_INDEX)
+    assert messages == before
+
+
+def test_compact_history_keeps_prefix_prompt_and_window():
+    messages = history_after(3)
+    window = messages[-HISTORY_WINDOW:]
+    compact_history(messages, PROMPT_INDEX)
+
+    assert messages[: PROMPT_INDEX + 1] == [*SYSTEM_PREFIX, {"role": "user", "content": "prompt"}]
+    assert messages[-HISTORY_WINDOW:] == window
+    assert len(messages) == PROMPT_INDEX + 2 + HISTORY_WINDOW
+    assert summary_lines(messages) == ["- assistant: raw0", "- user: Tool result: ok"]
+
+
+def test_compact_history_merges_previous_summary_without_nesting():
+    messages = history_after(5)
+    compact_history(messages, PROMPT_INDEX)
+
+    lines = summary_lines(messages)
+    assert lines == [
+        "- assistant: raw0",
+        "- user: Tool result: ok",
+        "- assistant: raw1",
+        "- user: Tool result: ok",
+        "- assistant: raw2",
+        "- user: Tool result: ok",
+    ]
+    assert sum(m["content"].startswith(HISTORY_SUMMARY_HEADER) for m in messages) == 1
+
+
+def test_compact_history_caps_summary_lines():
+    messages = history_after(20)
+    compact_history(messages, PROMPT_INDEX)
+
+    lines = summary_lines(messages)
+    assert len(lines) == MAX_SUMMARY_LINES
+    # The most recent folded steps are the ones kept.
+    assert lines[-2:] == ["- assistant: raw17", "- user: Tool result: ok"]
+    assert len(messages) == PROMPT_INDEX + 2 + HISTORY_WINDOW
+
+
+def test_compact_history_truncates_long_snippets_to_one_line():
+    messages = history_after(3, result="Tool result:\n" + "x" * 1000)
+    compact_history(messages, PROMPT_INDEX)
+
+    line = summary_lines(messages)[1]
+    assert "\n" not in line
+    assert line.endswith(" ...")
+    assert len(line) == len("- user: ") + HISTORY_SNIPPET_CHARS + len(" ...")